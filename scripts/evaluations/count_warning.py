@@ -1,25 +1,45 @@
 import os
+import mmap
+from concurrent.futures import ProcessPoolExecutor
 
 # Prepare for (absolute) paths
 root_dir = os.path.dirname(os.path.abspath(__file__))  # path to the current script
 output_dir = os.path.join(root_dir, "output")  # path to the output directory
-cases_dir = [os.path.join(output_dir, i) for i in os.listdir(output_dir)]  # paths to the all test cases
+cases_dir = [e.path for e in os.scandir(output_dir) if e.is_dir()]  # paths to the all test cases
+
+
+# Yield each warning in an output file as a pair of (the line containing the marker, the line after it),
+# one at a time, so that neither the file nor its list of lines is ever materialized
+def iter_warnings(output):
+    # `mmap` cannot map empty files
+    if os.path.getsize(output) == 0:
+        return
+    with open(output, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        pos = mm.find(b'[MirChecker]')
+        while pos != -1:
+            line_start = mm.rfind(b'\n', 0, pos) + 1
+            line_end = mm.find(b'\n', pos)
+            if line_end == -1:
+                return
+            next_end = mm.find(b'\n', line_end + 1)
+            if next_end == -1:
+                next_end = len(mm)
+            yield (mm[line_start:line_end].rstrip(), mm[line_end + 1:next_end].rstrip())
+            pos = mm.find(b'[MirChecker]', line_end)
 
 
 def count_warning(case_dir):
+    # Only the hashes of the warnings are kept, which is enough for deduplication
     warning_set = set()
-    output_files = [os.path.join(case_dir, i) for i in os.listdir(case_dir)]
+    output_files = [e.path for e in os.scandir(case_dir) if e.is_file()]
     for output in output_files:
-        with open(output) as f:
-            lines = [line.rstrip() for line in f]
-            for i in range(len(lines)):
-                if '[MirChecker]' in lines[i]:
-                    warning_set.add(lines[i]+lines[i+1])
-    print(len(warning_set))
+        warning_set.update(map(hash, iter_warnings(output)))
+    return len(warning_set)
 
 
 if __name__ == "__main__":
-    # For precision, run each evaluation sequentially instead of in parallel
-    for case_dir in cases_dir:
-        print(case_dir)
-        count_warning(case_dir)
+    # Each test case is counted independently, so scan them in parallel
+    with ProcessPoolExecutor() as executor:
+        for (case_dir, num_warning) in zip(cases_dir, executor.map(count_warning, cases_dir)):
+            print(case_dir)
+            print(num_warning)
@@ -23,7 +23,7 @@ root_dir = os.path.dirname(os.path.abspath(__file__))  # path to the current scr
 executable = os.path.abspath(os.path.join(root_dir, "../../target/release/cargo-mir-checker"))  # path to the cargo sub-command
 crate_dir = os.path.join(root_dir, "crates")  # path to the crate directory
 output_dir = os.path.join(root_dir, "outputs")  # path to the output directory
-test_cases_dir = [os.path.join(crate_dir, i) for i in os.listdir(crate_dir)]  # paths to the all test cases
+test_cases_dir = [e.path for e in os.scandir(crate_dir) if e.is_dir()]  # paths to the all test cases
 
 
 class EvaluationResult:
@@ -41,21 +41,26 @@ def run_task(task):
 
     print("Evaluating", crate_name, "with domain type:", domain, "entry function:", entry)
 
-    build_dir = os.path.abspath(os.path.join(crate_name, entry + "_" + domain + "_build"))
-    mkdir(build_dir)
+    build_dir = task["build_dir"]
+
+    # Only clean the crate itself but not its dependencies, so that it gets analyzed again
+    if not cargo_clean(crate_dir, "-p", task["package"], "--target-dir", build_dir):
+        print(bcolors.FAIL, "Error while cleaning crate", crate_name, "entry function:", entry, "domain type:", domain, bcolors.ENDC)
+        return None
 
-    # Run `cargo clean` to make sure it does not use cache
-    subprocess.Popen(["cargo", "clean", "--target-dir", build_dir], cwd=crate_dir).wait()
     # try:
     success = False
-    with subprocess.Popen(["/usr/bin/time", "-f", "%M\n%e", executable, "mir-checker", "--quiet",
+    # Use `time` command to get execution time and peak memory usage, which are written into this file
+    metrics_file = os.path.join(build_dir, "metrics")
+    with subprocess.Popen(["/usr/bin/time", "-f", "%M\n%e", "-o", metrics_file, executable, "mir-checker", "--quiet",
                            "--target-dir", build_dir, "--", "--entry", entry, "--domain", domain],
-                          cwd=crate_dir, stderr=subprocess.PIPE, preexec_fn=os.setsid) as process:
+                          cwd=crate_dir, stderr=subprocess.DEVNULL, start_new_session=True) as process:
         try:
-            out = process.communicate(timeout=300)[1]
+            process.wait(timeout=300)
 
             if process.returncode == 0:
-                out_str = out.decode("utf-8").split()
+                with open(metrics_file) as f:
+                    out_str = f.read().split()
                 elasp_time = float(out_str[-1])
                 peak_mem = int(out_str[-2])
 
@@ -67,12 +72,8 @@ def run_task(task):
                 print(bcolors.FAIL, "Error while analyzing crate", crate_name, "entry function:", entry, "domain type:", domain, bcolors.ENDC)
         except subprocess.TimeoutExpired:
             print(bcolors.FAIL, "Timeout while analyzing crate", crate_name, "entry function:", entry, "domain type:", domain, bcolors.ENDC)
-            os.killpg(process.pid, signal.SIGTERM)  # send signal to the process group
-
-    # Clean up
-    print("Cleaning up", build_dir)
-    subprocess.Popen(["cargo", "clean", "--target-dir", build_dir], cwd=crate_dir).wait()
-    # subprocess.Popen(["rm", "-rf", build_dir], cwd=crate_dir).wait()
+            os.killpg(process.pid, signal.SIGKILL)  # send signal to the process group
+            process.wait()
 
     if success:
         return (elasp_time, peak_mem)
@@ -81,18 +82,27 @@ def run_task(task):
 
 
 def evaluate(crate_dir):
-    entry_list = get_entry_list(crate_dir)
-    num_entry = len(entry_list)
-    # task_list = get_task_list(crate_dir)
     crate_name = os.path.basename(crate_dir)
-    mkdir(crate_name)
+    package = get_package_id(crate_dir)
+    if package is None:
+        print(bcolors.FAIL, "Cannot get the package ID of crate", crate_name, ", ignored", bcolors.ENDC)
+        return None
+
+    # All the tasks of this crate share one build directory, so dependencies are only compiled once
+    build_dir = os.path.abspath(os.path.join(crate_name, "build"))
+    # Remove anything left by an interrupted run, so that the entry functions are discovered
+    cargo_clean(crate_dir, "--target-dir", build_dir)
+    mkdir(build_dir)
+
+    entry_list = get_entry_list(crate_dir, build_dir)
+    num_entry = len(entry_list)
     print("Evaluating", crate_name, ", # of functions:", num_entry)
 
     elasptime = 0
     peakmem = 0
     for entry in entry_list:
         time_of_this_entry = 0
-        task_list = get_task_list(entry, crate_dir)
+        task_list = get_task_list(entry, crate_dir, build_dir, package)
         num_of_success = 0
         for task in task_list:
             result = run_task(task)
@@ -105,21 +115,28 @@ def evaluate(crate_dir):
 
         elasptime += time_of_this_entry
 
+    # Clean up
+    print("Cleaning up", build_dir)
+    cargo_clean(crate_dir, "--target-dir", build_dir)
+
     return EvaluationResult(crate_name, num_entry, elasptime, peakmem)
 
 
+# Run `cargo clean` in a crate directory and return whether it succeeds
+def cargo_clean(crate_dir, *args):
+    p = subprocess.run(["cargo", "clean"] + list(args), cwd=crate_dir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return p.returncode == 0
+
+
 # Create a directory (if it does not exist) in the current directory
 def mkdir(dir_name):
     if not os.path.exists(dir_name):
         os.makedirs(dir_name)
 
 
-def get_entry_list(crate_dir):
-    # First run `cargo clean` to make sure it does not use cache
-    subprocess.Popen(["cargo", "clean"], cwd=crate_dir).wait()
-
-    # Get a list of entry functions
-    p = subprocess.Popen([executable, "mir-checker", "--", "--show_entries"],
+def get_entry_list(crate_dir, build_dir):
+    # Get a list of entry functions, this also compiles all the dependencies into `build_dir`
+    p = subprocess.Popen([executable, "mir-checker", "--target-dir", build_dir, "--", "--show_entries"],
                          cwd=crate_dir, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
     entry_functions, _ = p.communicate()
     entry_functions = list(map(lambda x: str(x, "utf-8"), entry_functions.split()))
@@ -127,11 +144,23 @@ def get_entry_list(crate_dir):
     return entry_functions
 
 
-def get_task_list(entry_function, crate_dir):
+# Get the package ID of a crate, or `None` if it cannot be determined
+def get_package_id(crate_dir):
+    p = subprocess.Popen(["cargo", "pkgid"], cwd=crate_dir, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    package, _ = p.communicate()
+    package = str(package, "utf-8").strip()
+    if p.returncode != 0 or package == "":
+        return None
+    return package
+
+
+def get_task_list(entry_function, crate_dir, build_dir, package):
     task_list = []
     for domain in abstract_domains:
         task = {}
         task["crate_dir"] = crate_dir
+        task["build_dir"] = build_dir
+        task["package"] = package
         task["entry"] = entry_function
         task["domain"] = domain
         task_list.append(task)
@@ -152,6 +181,7 @@ if __name__ == "__main__":
     # For precision, run each evaluation sequentially instead of in parallel
     for case_dir in test_cases_dir:
         result = evaluate(case_dir)
-        eval_result.append(result)
+        if result is not None:
+            eval_result.append(result)
 
     show_result(eval_result)
@@ -1,11 +1,14 @@
 import os
 import sys
+import glob
+import json
+import hashlib
 import signal
 import itertools
 import subprocess
-import threading
+import functools
 import csv
-from multiprocessing.pool import ThreadPool
+from multiprocessing import Pool
 
 
 class bcolors:
@@ -40,85 +43,76 @@ abstract_domains = ["interval", "octagon", "polyhedra", "ppl_linear_congruences"
 root_dir = os.path.dirname(os.path.abspath(__file__))  # path to the current script
 crate_dir = os.path.join(root_dir, "crates")  # path to the crate directory
 output_dir = os.path.join(root_dir, "outputs")  # path to the output directory
-test_cases_dir = [os.path.join(crate_dir, i) for i in os.listdir(crate_dir)]  # paths to the all test cases
+build_root_dir = os.path.join(output_dir, "build")  # path to the build directories of all worker processes
+test_cases_dir = [e.path for e in os.scandir(crate_dir) if e.is_dir()]  # paths to the all test cases
 executable = os.path.abspath(os.path.join(root_dir, "../../target/release/cargo-mir-checker"))  # path to the cargo sub-command
 
-# Lock for the result
-lock = threading.Lock()
-result = []
-
-lock2 = threading.Lock()
-count = 0
-total_count = 0
+progress = itertools.count(1)
 failed_cases = set()
 
-def evaluate(task):
+# Crates whose dependencies have been compiled in their build directories of the current worker process
+prepared_crates = set()
+
+# Evaluate a task and return it as `(crate_name, domain, entry)` together with its result, which is `None` if the analysis fails
+def evaluate(task, cleaning_delay):
     crate_dir = task["crate_dir"]
     crate_name = os.path.basename(crate_dir)
     domain = task["domain"]
     entry = task["entry"]
-    global count
-    global result
-    global cleaning_delay
     print("Evaluating", crate_name, "with domain type:", domain, "entry function:", entry, "cleaning delay:", cleaning_delay)
 
-    build_dir = os.path.abspath(os.path.join(crate_name, entry + "_" + domain + "_build"))
+    # Each worker process has its own build directory for each crate, so parallel cargo invocations never wait for
+    # each other's lock, and cleaning one crate never removes a same-named dependency compiled for another crate
+    build_dir = os.path.join(build_root_dir, str(os.getpid()), crate_name)
     mkdir(build_dir)
 
-    # Run `cargo clean` to make sure it does not use cache
-    subprocess.Popen(["cargo", "clean", "--target-dir", build_dir], cwd=crate_dir).wait()
+    # Compile the dependencies before the measurement, once per crate and worker process
+    if crate_dir not in prepared_crates:
+        subprocess.run([executable, "mir-checker", "--target-dir", build_dir, "--", "--show_entries"], cwd=crate_dir,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        prepared_crates.add(crate_dir)
+
+    # Only clean the crate itself but not its dependencies, so that it gets analyzed again
+    if not cargo_clean(crate_dir, "-p", task["package"], "--target-dir", build_dir):
+        print(bcolors.FAIL, "Error while cleaning crate", crate_name, "entry function:", entry, "domain type:", domain, bcolors.ENDC)
+        return ((crate_name, domain, entry), None)
 
     timeout_sec = 60
 
-    # Use `time` command to get execution time and peak memory usage
-    with subprocess.Popen(["/usr/bin/time", "-f", "%M\n%e", executable, "mir-checker", "--quiet",
+    # Use `time` command to get execution time and peak memory usage, which are written into this file
+    metrics_file = os.path.join(build_dir, "metrics")
+    with subprocess.Popen(["/usr/bin/time", "-f", "%M\n%e", "-o", metrics_file, executable, "mir-checker", "--quiet",
                            "--target-dir", build_dir, "--", "--entry", entry, "--domain", domain, "--cleaning_delay",
-                           str(cleaning_delay)], cwd=crate_dir, stderr=subprocess.PIPE, preexec_fn=os.setsid) as process:
+                           str(cleaning_delay)], cwd=crate_dir, stderr=subprocess.DEVNULL, start_new_session=True) as process:
         try:
-            out = process.communicate(timeout=timeout_sec)[1]
+            process.wait(timeout=timeout_sec)
 
             if process.returncode == 0:
-                out_str = out.decode("utf-8").split()
+                with open(metrics_file) as f:
+                    out_str = f.read().split()
                 elasp_time = float(out_str[-1])
                 peak_mem = int(out_str[-2])
 
-                if lock.acquire():
-                    result.append(EvaluationResult(crate_name, domain, entry, elasp_time, peak_mem))
-                    lock.release()
-
-                if lock2.acquire():
-                    count += 1
-                    print("Progress:", count, "/", total_count)
-                    lock2.release()
-
                 print(bcolors.OKBLUE, "Finish analyzing crate", crate_name, "entry function:", entry,
                       "domain type:", domain, "peak memory:", peak_mem, "elasp time:", elasp_time, bcolors.ENDC)
+                return ((crate_name, domain, entry), EvaluationResult(crate_name, domain, entry, elasp_time, peak_mem))
 
             else:
                 print(bcolors.FAIL, "Error while analyzing crate", crate_name, "entry function:", entry, "domain type:", domain, bcolors.ENDC)
-                if lock2.acquire():
-                    count += 1
-                    print("Progress:", count, "/", total_count)
-                    failed_cases.add((crate_name, domain, entry))
-                    lock2.release()
+                return ((crate_name, domain, entry), None)
 
         except subprocess.TimeoutExpired:
             print(bcolors.FAIL, "Timeout while analyzing crate", crate_name, "entry function:", entry, "domain type:", domain, bcolors.ENDC)
 
-            if lock.acquire():
-                result.append(EvaluationResult(crate_name, domain, entry, timeout_sec, 0))
-                lock.release()
+            os.killpg(process.pid, signal.SIGKILL)  # send signal to the process group
+            process.wait()
+            return ((crate_name, domain, entry), EvaluationResult(crate_name, domain, entry, timeout_sec, 0))
 
-            if lock2.acquire():
-                count += 1
-                print("Progress:", count, "/", total_count)
-                lock2.release()
-            os.killpg(process.pid, signal.SIGTERM)  # send signal to the process group
 
-    # Clean up
-    print("Cleaning up", build_dir)
-    subprocess.Popen(["cargo", "clean", "--target-dir", build_dir], cwd=crate_dir).wait()
-    # p = subprocess.Popen(["rm", "-rf", build_dir], cwd=crate_dir)
+# Run `cargo clean` in a crate directory and return whether it succeeds
+def cargo_clean(crate_dir, *args):
+    p = subprocess.run(["cargo", "clean"] + list(args), cwd=crate_dir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return p.returncode == 0
 
 
 # Create a directory (if it does not exist) in the current directory
@@ -127,35 +121,85 @@ def mkdir(dir_name):
         os.makedirs(dir_name)
 
 
-# Lock for the global task list
-task_list_lock = threading.Lock()
-task_list = []
+# Get the package ID of a crate, or `None` if it cannot be determined
+def get_package_id(crate_dir):
+    p = subprocess.Popen(["cargo", "pkgid"], cwd=crate_dir, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    package, _ = p.communicate()
+    package = str(package, "utf-8").strip()
+    if p.returncode != 0 or package == "":
+        return None
+    return package
+
+
+# Compute a key that changes whenever `Cargo.toml`, any source file or the checker itself changes
+def get_cache_key(crate_dir):
+    h = hashlib.blake2b()
+    with open(os.path.join(crate_dir, "Cargo.toml"), "rb") as f:
+        h.update(f.read())
+    for (dirpath, dirnames, filenames) in os.walk(os.path.join(crate_dir, "src")):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if filename.endswith(".rs"):
+                path = os.path.join(dirpath, filename)
+                h.update("{}:{}".format(path, os.stat(path).st_mtime_ns).encode())
+    h.update(str(os.stat(executable).st_mtime_ns).encode())
+    return h.hexdigest()
+
+
+# Get a list of entry functions, the result is cached in the crate directory
+# so that the expensive discovery is skipped if the crate has not changed
+def get_entry_functions(crate_dir):
+    cache_file = os.path.join(crate_dir, ".mir-checker-entries.json")
+    key = get_cache_key(crate_dir)
+    if os.path.exists(cache_file):
+        with open(cache_file) as f:
+            cache = json.load(f)
+        if cache["key"] == key:
+            return cache["entries"]
 
-def get_task_list(crate_dir):
-    crate_name = os.path.basename(crate_dir)
     # First run `cargo clean` to make sure it does not use cache
-    subprocess.Popen(["cargo", "clean"], cwd=crate_dir).wait()
+    cargo_clean(crate_dir)
 
-    # Get a list of entry functions
-    p = subprocess.Popen([executable, "mir-checker", "--", "--show_entries"],
-                         cwd=crate_dir, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    p = subprocess.Popen([executable, "mir-checker", "--", "--show_entries"], cwd=crate_dir, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
     entry_functions, _ = p.communicate()
     entry_functions = list(map(lambda x: str(x, "utf-8"), entry_functions.split()))
 
+    # Do not cache failures, they may be caused by something outside the crate (e.g., network)
+    if p.returncode == 0:
+        with open(cache_file, "w") as f:
+            json.dump({"key": key, "entries": entry_functions}, f)
+    return entry_functions
+
+
+# Total size of the source files of a crate, used as an estimate of how long it takes to analyze the crate
+def get_crate_size(crate_dir):
+    size = os.path.getsize(os.path.join(crate_dir, "Cargo.toml"))
+    for path in glob.glob(os.path.join(crate_dir, "src", "**", "*.rs"), recursive=True):
+        size += os.path.getsize(path)
+    return size
+
+
+# Get the list of tasks of a crate, which is empty if the crate cannot be analyzed
+def get_task_list(crate_dir):
+    if not os.path.exists(os.path.join(crate_dir, "Cargo.toml")):
+        return []
+    entry_functions = get_entry_functions(crate_dir)
+    package = get_package_id(crate_dir)
+    if package is None:
+        print(bcolors.WARNING, "Cannot get the package ID of crate", os.path.basename(crate_dir), ", ignored", bcolors.ENDC)
+        return []
+
     result = []
 
     for (entry, domain) in itertools.product(entry_functions, abstract_domains):
         task = {}
         task["crate_dir"] = crate_dir
+        task["package"] = package
         task["entry"] = entry
         task["domain"] = domain
         result.append(task)
 
-    if task_list_lock.acquire():
-        global task_list
-        task_list += result
-        mkdir(crate_name)
-        task_list_lock.release()
+    return result
 
 
 def process_result(result):
@@ -175,61 +219,63 @@ def process_result(result):
     return output
 
 
+# Write the total time and the peak memory of each crate under each abstract domain into a CSV file
+def dump_csv(path, result):
+    result_dict = process_result(result)
+    with open(path, 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow([''] + abstract_domains + abstract_domains)
+        writer.writerows([name] + [domain_dict[domain][0] for domain in abstract_domains]
+                         + [domain_dict[domain][1] for domain in abstract_domains]
+                         for (name, domain_dict) in result_dict.items())
+
+
+# Evaluate all the tasks with the given cleaning delay and write the result into a CSV file.
+# Workers return their results instead of updating shared state, and they are collected here
+def run_pass(pool, task_list, total_count, cleaning_delay, csv_path):
+    result = []
+    for (case, r) in pool.imap_unordered(functools.partial(evaluate, cleaning_delay=cleaning_delay), task_list):
+        print("Progress:", next(progress), "/", total_count)
+        if r is None:
+            failed_cases.add(case)
+        else:
+            result.append(r)
+
+    dump_csv(csv_path, result)
+
+
 if __name__ == "__main__":
     if len(sys.argv) != 2:
-        print("Need an argument to specify the size of the thread pool")
+        print("Need an argument to specify the size of the process pool")
         exit(1)
 
-    num_thread = int(sys.argv[1])
+    num_process = int(sys.argv[1])
 
     mkdir(output_dir)
     os.chdir(output_dir)
 
-    with ThreadPool(num_thread) as p:
-        p.map(get_task_list, test_cases_dir)
+    with Pool(num_process) as p:
+        task_list = list(itertools.chain.from_iterable(p.map(get_task_list, test_cases_dir)))
 
     total_count = len(task_list)*2
 
-    print(len(task_list)*2, "tasks in total, run in", num_thread, "threads")
-
-    # 1st run
-    cleaning_delay = 0
-    with ThreadPool(num_thread) as p:
-        p.map(evaluate, task_list)
-
-    with open('eval_result_nocleanup.csv', 'w', newline='') as csvfile:
-        spamwriter = csv.writer(csvfile)
-        spamwriter.writerow([''] + abstract_domains + abstract_domains)
-        result_dict = process_result(result)
-        for (name, domain_dict) in result_dict.items():
-            res = []
-            for domain in abstract_domains:
-                (t, m) = domain_dict[domain]
-                res.append(str(t))
-            for domain in abstract_domains:
-                (t, m) = domain_dict[domain]
-                res.append(str(m))
-            spamwriter.writerow([name] + res)
+    print(len(task_list)*2, "tasks in total, run in", num_process, "processes")
 
-    result = []
+    # Task runtimes vary from milliseconds to the timeout, so let each worker pull the next task as soon
+    # as it becomes free, and start with the largest crates so that no long task is left to the end
+    crate_size = {crate_dir: get_crate_size(crate_dir) for crate_dir in set(task["crate_dir"] for task in task_list)}
+    task_list.sort(key=lambda task: crate_size[task["crate_dir"]], reverse=True)
 
-    # 2nd run
-    cleaning_delay = 1
-    with ThreadPool(num_thread) as p:
-        p.map(evaluate, task_list)
-
-    with open('eval_result.csv', 'w', newline='') as csvfile:
-        spamwriter = csv.writer(csvfile)
-        spamwriter.writerow([''] + abstract_domains + abstract_domains)
-        result_dict = process_result(result)
-        for (name, domain_dict) in result_dict.items():
-            res = []
-            for domain in abstract_domains:
-                (t, m) = domain_dict[domain]
-                res.append(str(t))
-            for domain in abstract_domains:
-                (t, m) = domain_dict[domain]
-                res.append(str(m))
-            spamwriter.writerow([name] + res)
+    # Both runs share the same worker processes, so the build directories (and the
+    # dependencies compiled in them) of the 1st run are reused by the 2nd run
+    with Pool(num_process) as p:
+        # 1st run
+        run_pass(p, task_list, total_count, 0, 'eval_result_nocleanup.csv')
+        # 2nd run
+        run_pass(p, task_list, total_count, 1, 'eval_result.csv')
+
+    # Clean up
+    print("Cleaning up", build_root_dir)
+    subprocess.run(["rm", "-rf", build_root_dir], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
 
     print(failed_cases)
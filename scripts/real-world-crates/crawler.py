@@ -1,16 +1,23 @@
 import requests
 import os
+import re
+import threading
 from subprocess import Popen, DEVNULL
+from concurrent.futures import ThreadPoolExecutor
 
 def make_crate_list(category, page_list):
     category_str = "" if category == "" else "category=" + category
     crate_list = []
-    for page in page_list:
-        request_page = requests.get('https://crates.io/api/v1/crates?{}&page={}&per_page=100&sort=downloads'.format(category_str, page))
-        crate_list += request_page.json()['crates']
+    # Reuse one connection for all the pages instead of opening a new one for each request
+    with requests.Session() as session:
+        for page in page_list:
+            request_page = session.get('https://crates.io/api/v1/crates?{}&page={}&per_page=100&sort=downloads'.format(category_str, page))
+            crate_list += request_page.json()['crates']
     return crate_list
 
 
+# Lock for the set of cloned repositories, since repositories are cloned in parallel
+repo_set_lock = threading.Lock()
 repo_set = set()
 def clone_repo(name, repo):
     # crates.io API may not always correctly return the repository address
@@ -19,12 +26,19 @@ def clone_repo(name, repo):
         return False
 
     global repo_set
-    if repo in repo_set:
+    with repo_set_lock:
+        already_cloned = repo in repo_set
+        repo_set.add(repo)
+
+    if already_cloned:
         # Do not clone repositories that have already been cloned
         print("Warning:", name, "is ignored because it has already been cloned from", repo)
         return False
+    elif os.path.isdir(name):
+        # The repository has been cloned in a previous run, no need to spawn `git clone` again
+        print("Skipping repo:", name, "because it already exists")
+        return True
     else:
-        repo_set.add(repo)
         print("Cloning repo: ", name, "from:", repo)
         my_env = os.environ.copy()
         my_env["GIT_TERMINAL_PROMPT"] = "0"  # Some repositories need username and password, use this to fail instead of prompting for credentials
@@ -35,29 +49,35 @@ def clone_repo(name, repo):
             return False
         return True
 
+# Exclude crates that are related to FFI, macro/trait definitions, multi-threads, etc.
+keywords = ["ffi", "macro", "binding", "wrapper", "float", "api", "abi", "trait", "concurrent",
+            "async", "pin", "mutex", "lock", "atomic", "thread", "string", "rational", "libm",
+            "cortex", "hal", "simd", "asm", "sys", "stm32", "arch", "gpio"]
+# Match all the keywords in a single pass
+keywords_re = re.compile("|".join(map(re.escape, keywords)), re.IGNORECASE)
+
 def should_ignore(name, description):
-    description = description.lower()
-    # Exclude crates that are related to FFI, macro/trait definitions, multi-threads, etc.
-    keywords = ["ffi", "macro", "binding", "wrapper", "float", "api", "abi", "trait", "concurrent",
-                "async", "pin", "mutex", "lock", "atomic", "thread", "string", "rational", "libm",
-                "cortex", "hal", "simd", "asm", "sys", "stm32", "arch", "gpio"]
-    if any([keyword in name + description for keyword in keywords]):
+    if keywords_re.search(name + description):
         print("Warning:", name, "is ignored because it is not our concern")
         return True
     return False
 
 
-count = 0
-print("Requesting the API of crates.io...")
-crate_list = make_crate_list("no-std", [11, 12, 13, 14, 15, 16, 17, 18, 19, 20])
-print("Got addresses of {} crates, start cloning...".format(len(crate_list)))
-for crate in crate_list:
+def process_crate(crate):
     name = crate['name']
-    description = crate['description']
+    description = crate['description'] or ""
     repo = crate['repository']
 
     if not should_ignore(name, description):
-        if clone_repo(name, repo):
-            count += 1
+        return clone_repo(name, repo)
+    return False
+
+
+print("Requesting the API of crates.io...")
+crate_list = make_crate_list("no-std", [11, 12, 13, 14, 15, 16, 17, 18, 19, 20])
+print("Got addresses of {} crates, start cloning...".format(len(crate_list)))
+# Cloning is I/O-bound, so clone several repositories at the same time
+with ThreadPoolExecutor(max_workers=16) as executor:
+    count = sum(executor.map(process_crate, crate_list))
 
 print(count, "crates cloned")
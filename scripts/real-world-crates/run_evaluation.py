@@ -1,10 +1,14 @@
 import os
 import sys
+import json
+import hashlib
 import signal
 import itertools
+import shutil
 import subprocess
 import threading
-from multiprocessing.pool import ThreadPool
+import queue
+from multiprocessing import Pool
 
 class bcolors:
     HEADER = '\033[95m'
@@ -27,17 +31,10 @@ root_dir = os.path.dirname(os.path.abspath(__file__))  # path to the current scr
 executable = os.path.abspath(os.path.join(root_dir, "../../target/release/cargo-mir-checker"))  # path to the cargo sub-command
 output_dir = os.path.join(root_dir, "output")  # path to the output directory
 # paths to the all test cases
-test_cases = [os.path.abspath(i) for i in os.listdir(root_dir)
-              if os.path.isdir(os.path.join(root_dir, i)) and os.path.abspath(i) != output_dir]
-
-# Lock for the global counters
-lock = threading.Lock()
-total_count = 0
-success_count = 0
-fail_count = 0
-timeout_count = 0
+test_cases = [e.path for e in os.scandir(root_dir) if e.is_dir() and e.path != output_dir]
 
 
+# Evaluate a task and return its status, which is one of "success", "fail" and "timeout"
 def evaluate(task):
     crate_dir = task["crate_dir"]
     crate_name = os.path.basename(crate_dir)
@@ -45,20 +42,16 @@ def evaluate(task):
     entry = task["entry"]
 
     print("Evaluating", crate_name, "with domain type:", domain, "entry function:", entry)
-    if lock.acquire():
-        global total_count
-        total_count += 1
-        lock.release()
 
-    build_dir = os.path.abspath(os.path.join(crate_name, entry + "_" + domain + "_build"))
-    mkdir(build_dir)
+    build_dir = task["build_dir"]
 
-    # Run `cargo clean` to make sure it does not use cache
-    p = subprocess.Popen(["cargo", "clean", "--target-dir", build_dir], cwd=crate_dir)
-    p.wait()
+    # Only clean the crate itself but not its dependencies, so that it gets analyzed again
+    if not cargo_clean(crate_dir, "-p", task["package"], "--target-dir", build_dir):
+        print(bcolors.FAIL, "Error while cleaning crate", crate_name, "entry function:", entry, "domain type:", domain, bcolors.ENDC)
+        return "fail"
     # try:
     with subprocess.Popen([executable, "mir-checker", "--target-dir", build_dir, "--", "--entry_def_id_index", entry, "--domain", domain],
-                          cwd=crate_dir, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, preexec_fn=os.setsid) as process:
+                          cwd=crate_dir, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, start_new_session=True) as process:
         try:
             out = process.communicate(timeout=300)[0]
 
@@ -73,29 +66,42 @@ def evaluate(task):
                     f.write(out_str)
                     f.close()
 
-                if lock.acquire():
-                    global success_count
-                    success_count += 1
-                    lock.release()
+                return "success"
             else:
                 print(bcolors.FAIL, "Error while analyzing crate", crate_name, "entry function:", entry, "domain type:", domain, bcolors.ENDC)
-                if lock.acquire():
-                    global fail_count
-                    fail_count += 1
-                    lock.release()
+                return "fail"
         except subprocess.TimeoutExpired:
             print(bcolors.FAIL, "Timeout while analyzing crate", crate_name, "entry function:", entry, "domain type:", domain, bcolors.ENDC)
-            os.killpg(process.pid, signal.SIGTERM)  # send signal to the process group
-            if lock.acquire():
-                global timeout_count
-                timeout_count += 1
-                lock.release()
-
-    # Clean up
-    print("Cleaning up", build_dir)
-    # p = subprocess.Popen(["cargo", "clean", "--target-dir", build_dir], cwd=crate_dir)
-    p = subprocess.Popen(["rm", "-rf", build_dir], cwd=crate_dir)
-    p.wait()
+            os.killpg(process.pid, signal.SIGKILL)  # send signal to the process group
+            process.wait()
+            return "timeout"
+
+
+# Evaluate all the tasks of a crate one by one, since they share the same build directory.
+# The build directory is returned so that the reaper thread can remove it
+def evaluate_crate(crate_tasks):
+    statuses = [evaluate(task) for task in crate_tasks]
+    return (crate_tasks[0]["build_dir"], statuses)
+
+
+# Build directories of finished crates are removed by a background thread,
+# so that workers can move on to the next crate right away
+reap_queue = queue.Queue()
+
+def reaper():
+    while True:
+        build_dir = reap_queue.get()
+        if build_dir is None:
+            break
+        print("Cleaning up", build_dir)
+        shutil.rmtree(build_dir, ignore_errors=True)
+
+
+# Run `cargo clean` in a crate directory and return whether it succeeds
+def cargo_clean(crate_dir, *args):
+    p = subprocess.run(["cargo", "clean"] + list(args), cwd=crate_dir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return p.returncode == 0
+
 
 # Create a directory (if it does not exist) in the current directory
 def mkdir(dir_name):
@@ -103,27 +109,81 @@ def mkdir(dir_name):
         os.makedirs(dir_name)
 
 
-# Lock for the global task list
-task_list_lock = threading.Lock()
-task_list = []
+# Get the package ID of a crate, or `None` if it cannot be determined
+def get_package_id(crate_dir):
+    p = subprocess.Popen(["cargo", "pkgid"], cwd=crate_dir, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    package, _ = p.communicate()
+    package = str(package, "utf-8").strip()
+    if p.returncode != 0 or package == "":
+        return None
+    return package
+
+
+# Compute a key that changes whenever `Cargo.toml`, `Cargo.lock`, any source file or the checker itself changes.
+# The entry functions are identified by indices, which also shift when the dependencies change
+def get_cache_key(crate_dir):
+    h = hashlib.blake2b()
+    for manifest in ["Cargo.toml", "Cargo.lock"]:
+        path = os.path.join(crate_dir, manifest)
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                h.update(f.read())
+    for (dirpath, dirnames, filenames) in os.walk(os.path.join(crate_dir, "src")):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if filename.endswith(".rs"):
+                path = os.path.join(dirpath, filename)
+                h.update("{}:{}".format(path, os.stat(path).st_mtime_ns).encode())
+    h.update(str(os.stat(executable).st_mtime_ns).encode())
+    return h.hexdigest()
+
+
+# Get a list of indices of entry functions, this also compiles all the dependencies into `build_dir`.
+# Only the list is cached in the crate directory, since `build_dir` is removed once the crate is analyzed
+def get_entry_functions(crate_dir, build_dir):
+    cache_file = os.path.join(crate_dir, ".mir-checker-entries-index.json")
+    key = get_cache_key(crate_dir)
+    if os.path.exists(cache_file):
+        with open(cache_file) as f:
+            cache = json.load(f)
+        if cache["key"] == key:
+            return cache["entries"]
+
+    p = subprocess.Popen([executable, "mir-checker", "--target-dir", build_dir, "--", "--show_entries_index"], cwd=crate_dir, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    entry_functions, _ = p.communicate()
+    entry_functions = list(map(lambda x: str(x, "utf-8"), entry_functions.split()))
+
+    # Do not cache failures, they may be caused by something outside the crate (e.g., network).
+    # The key is computed again because the build may have generated `Cargo.lock`
+    if p.returncode == 0:
+        with open(cache_file, "w") as f:
+            json.dump({"key": get_cache_key(crate_dir), "entries": entry_functions}, f)
+    return entry_functions
 
+
+# Get the list of tasks of a crate, or `None` if the crate cannot be analyzed
 def get_task_list(crate_dir):
     if not os.path.exists(os.path.join(crate_dir, "Cargo.toml")):
         return None
     crate_name = os.path.basename(crate_dir)
-    # First run `cargo clean` to make sure it does not use cache
-    p = subprocess.Popen(["cargo", "clean"], cwd=crate_dir)
-    p.wait()
+    # All the tasks of this crate share one build directory, so dependencies are only compiled once
+    build_dir = os.path.abspath(os.path.join(crate_name, "build"))
+    # Remove anything left by an interrupted run, so that the entry functions are discovered
+    cargo_clean(crate_dir, "--target-dir", build_dir)
+    mkdir(build_dir)
 
-    # Get a list of entry functions
-    p = subprocess.Popen([executable, "mir-checker", "--", "--show_entries_index"],
-                         cwd=crate_dir, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
-    entry_functions, _ = p.communicate()
-    entry_functions = list(map(lambda x: str(x, "utf-8"), entry_functions.split()))
+    entry_functions = get_entry_functions(crate_dir, build_dir)
+
+    package = get_package_id(crate_dir)
 
     if len(entry_functions) == 0:
         # The crate being analyzed has no usable entry functions, just ignore
         print(bcolors.WARNING, crate_name, "has no usable entry points, ignored", bcolors.ENDC)
+        shutil.rmtree(build_dir, ignore_errors=True)
+        return None
+    elif package is None:
+        print(bcolors.WARNING, "Cannot get the package ID of crate", crate_name, ", ignored", bcolors.ENDC)
+        shutil.rmtree(build_dir, ignore_errors=True)
         return None
     else:
         result = []
@@ -131,34 +191,52 @@ def get_task_list(crate_dir):
         for (entry, domain) in itertools.product(entry_functions, abstract_domains):
             task = {}
             task["crate_dir"] = crate_dir
+            task["build_dir"] = build_dir
+            task["package"] = package
             task["entry"] = entry
             task["domain"] = domain
             result.append(task)
 
-        if task_list_lock.acquire():
-            global task_list
-            if result is not None:
-                task_list += result
-                mkdir(crate_name)
-            task_list_lock.release()
+        return result
 
 
 if __name__ == "__main__":
     if len(sys.argv) != 2:
-        print("Need an argument to specify the size of the thread pool")
+        print("Need an argument to specify the size of the process pool")
         exit(1)
 
-    num_thread = int(sys.argv[1])
+    num_process = int(sys.argv[1])
 
     mkdir(output_dir)
     os.chdir(output_dir)
 
-    with ThreadPool(num_thread) as p:
-        p.map(get_task_list, test_cases)
+    # Each element of `task_list` is the list of tasks of one crate
+    with Pool(num_process) as p:
+        task_list = [tasks for tasks in p.map(get_task_list, test_cases) if tasks is not None]
 
-    print(len(task_list), "tasks in total")
+    print(sum(map(len, task_list)), "tasks in total")
 
-    with ThreadPool(num_thread) as p:
-        p.map(evaluate, task_list)
+    # Let each worker pull the next crate as soon as it becomes free, and start with the crates that
+    # have the most tasks (each of them may run until the timeout) so that no long crate is left to the end
+    task_list.sort(key=len, reverse=True)
+
+    statuses = []
+    with Pool(num_process) as p:
+        # Start the reaper only after the workers are forked, and always stop it,
+        # otherwise an exception or Ctrl-C would leave the process waiting for it
+        reaper_thread = threading.Thread(target=reaper)
+        reaper_thread.start()
+        try:
+            for (build_dir, crate_statuses) in p.imap_unordered(evaluate_crate, task_list):
+                reap_queue.put(build_dir)
+                statuses += crate_statuses
+        finally:
+            reap_queue.put(None)
+            reaper_thread.join()
+
+    total_count = len(statuses)
+    success_count = statuses.count("success")
+    fail_count = statuses.count("fail")
+    timeout_count = statuses.count("timeout")
 
     print("Done with success:", success_count, ", fail:", fail_count, ", timeout:", timeout_count, ", total:", total_count)
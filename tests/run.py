@@ -3,8 +3,11 @@
 
 import os
 import sys
+import itertools
 import subprocess
+import tempfile
 import time
+from concurrent.futures import ProcessPoolExecutor
 
 unit_tests_list = [
     {"name": "alloc-test", "entry": "main"},
@@ -52,39 +55,54 @@ abstract_domains = ["interval", "octagon", "polyhedra", "linear_equalities", "pp
 executable = os.path.abspath("../target/debug/cargo-mir-checker")
 
 
-def run_test(test_list, test_dir, allow_error):
-    # for (test, domain_type) in itertools.product(test_list, abstract_domains):
-    for test in test_list:
-        ok = False
-        for domain_type in abstract_domains:
-            # First run cargo clean to make sure that cargo does not use cache
-            p = subprocess.Popen(["cargo", "clean"], cwd=os.path.join(test_dir, test["name"]))
-            p.wait()
+# Run a single (test, domain) pair and return whether the checker succeeds together with its output
+def run_one(task):
+    (test, test_dir, domain_type) = task
+    my_env = os.environ.copy()
+    # Disabling logging will save a lot of execution time!
+    # my_env["RUST_LOG"] = "rust_mir_checker"
 
-            my_env = os.environ.copy()
-            # Disabling logging will save a lot of execution time!
-            # my_env["RUST_LOG"] = "rust_mir_checker"
+    # Each task uses its own fresh target directory, so cargo does not use cache
+    # and parallel tasks do not wait for each other's cargo lock
+    with tempfile.TemporaryDirectory() as target_dir:
+        # Customized options
+        p = subprocess.Popen([executable, "mir-checker", "--target-dir", target_dir, "--", "--domain", domain_type, "--entry", test["entry"],
+                             "--widening_delay", "5", "--narrowing_iteration", "5", "--deny_warnings"],
+                             cwd=os.path.join(test_dir, test["name"]), env=my_env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output, _ = p.communicate()
+        return (test["name"], domain_type, p.returncode == 0, str(output, "utf-8", errors="replace"))
 
-            # Customized options
-            p = subprocess.Popen([executable, "mir-checker", "--", "--domain", domain_type, "--entry", test["entry"], "--widening_delay", "5",
-                                 "--narrowing_iteration", "5", "--deny_warnings"], cwd=os.path.join(test_dir, test["name"]), env=my_env)
-            p.communicate()[0]
-            rc = p.returncode
-            if rc == 0:
-                ok = True
 
+def run_test(test_list, test_dir, allow_error):
+    # Every (test, domain) pair is independent, so run them in parallel
+    tasks = [(test, test_dir, domain_type) for (test, domain_type) in itertools.product(test_list, abstract_domains)]
+    with ProcessPoolExecutor(os.cpu_count()) as executor:
+        results = []
+        # Print the output of each task as a whole, so that the outputs of parallel tasks do not interleave
+        for (name, domain_type, success, output) in executor.map(run_one, tasks):
+            print("==========", test_dir + "/" + name, "with domain", domain_type, "==========")
+            print(output, end="")
+            results.append((name, domain_type, success))
+
+    for test in test_list:
+        # At least one abstract domain should succeed
+        ok = any(success for (name, _, success) in results if name == test["name"])
         if not ok and not allow_error:
+            for (name, domain_type, _) in results:
+                if name == test["name"]:
+                    print("Failed:", test_dir + "/" + name, "with domain", domain_type)
             raise Exception("All abstract domains cannot reason about the verification conditions for \"{}\"".format(test["name"]))
 
 
-# Run tests
-try:
-    start = time.time()
-    run_test(unit_tests_list, "unit-tests", False)
-    run_test(safe_bugs_list, "safe-bugs", True)
-    run_test(unsafe_bugs_list, "unsafe-bugs", True)
-    end = time.time()
-    print("All tests are passed! Elapsed time:", end - start)
-except Exception as e:
-    print(e)
-    sys.exit(1)  # This error code will cause a failure in CI service, so we know there are some problems
+if __name__ == "__main__":
+    # Run tests
+    try:
+        start = time.time()
+        run_test(unit_tests_list, "unit-tests", False)
+        run_test(safe_bugs_list, "safe-bugs", True)
+        run_test(unsafe_bugs_list, "unsafe-bugs", True)
+        end = time.time()
+        print("All tests are passed! Elapsed time:", end - start)
+    except Exception as e:
+        print(e)
+        sys.exit(1)  # This error code will cause a failure in CI service, so we know there are some problems